@@ -4,7 +4,9 @@ from app.schemas.quiz import (
     QuizGenerationResponse
 )
 from app.core.supabase import get_supabase
+from app.core.async_db import run_db_operation
 from app.services.quiz_generation_service import QuizGenerationService
+import asyncio
 import logging
 
 router = APIRouter()
@@ -26,8 +28,15 @@ async def trigger_quiz_generation(
     Useful for regeneration or if automatic generation failed.
     """
     try:
-        # Verify document exists
-        doc_response = supabase.table("documents").select("*").eq("id", request.document_id).single().execute()  # type: ignore
+        # The document check and the existing-quiz check are independent,
+        # so run them concurrently instead of paying two round-trips in series.
+        doc_task = run_db_operation(
+            lambda: supabase.table("documents").select("id,user_id,status").eq("id", request.document_id).single().execute()  # type: ignore
+        )
+        quiz_task = run_db_operation(
+            lambda: supabase.table("quizzes").select("id, generation_status").eq("document_id", request.document_id).execute()  # type: ignore
+        )
+        doc_response, existing_quiz = await asyncio.gather(doc_task, quiz_task)
 
         if not doc_response.data:
             raise HTTPException(status_code=404, detail="Document not found")
@@ -45,9 +54,7 @@ async def trigger_quiz_generation(
                 detail="Document must be processed before generating a quiz"
             )
 
-        # Check if quiz already exists
-        existing_quiz = supabase.table("quizzes").select("id, generation_status").eq("document_id", request.document_id).execute()  # type: ignore
-
+        # Check if quiz already exists (fetched concurrently above)
         if existing_quiz.data and len(existing_quiz.data) > 0:  # type: ignore[arg-type]
             quiz_id = existing_quiz.data[0]["id"]  # type: ignore[index]
             status = existing_quiz.data[0]["generation_status"]  # type: ignore[index]
@@ -65,9 +72,13 @@ async def trigger_quiz_generation(
             # If completed, allow regeneration by deleting the old quiz
             if status == "completed":
                 logging.info(f"Deleting existing quiz {quiz_id} for regeneration")
-                # Delete old questions and quiz
-                supabase.table("questions").delete().eq("quiz_id", quiz_id).execute()  # type: ignore
-                supabase.table("quizzes").delete().eq("id", quiz_id).execute()  # type: ignore
+                # Delete old questions and quiz (ASYNC)
+                await run_db_operation(
+                    lambda: supabase.table("questions").delete().eq("quiz_id", quiz_id).execute()  # type: ignore
+                )
+                await run_db_operation(
+                    lambda: supabase.table("quizzes").delete().eq("id", quiz_id).execute()  # type: ignore
+                )
 
         # Trigger generation in background
         background_tasks.add_task(
@@ -0,0 +1,19 @@
+from functools import lru_cache
+import httpx
+from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient
+from app.core.config import get_settings
+
+
+@lru_cache(maxsize=1)
+def get_anthropic() -> AsyncAnthropic:
+    # One client per process so concurrent analysis/generation calls share
+    # a keep-alive pool instead of paying TCP/TLS handshakes per service
+    # instance. HTTP/2 multiplexes concurrent requests over one connection.
+    return AsyncAnthropic(
+        api_key=get_settings().ANTHROPIC_API_KEY,
+        http_client=DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            timeout=httpx.Timeout(120.0),
+        ),
+    )
@@ -10,15 +10,34 @@ IMPORTANT: Always use these helpers instead of direct .execute() calls in async
 
 import asyncio
 import logging
+import os
+import httpx
 from functools import partial
 from typing import TypeVar, Callable, Any
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 logger = logging.getLogger(__name__)
 
-# Dedicated thread pool for database operations
-# Using a separate pool prevents database I/O from competing with other async tasks
-_db_executor = ThreadPoolExecutor(max_workers=10, thread_name_prefix="supabase_db_")
+# Dedicated thread pool for database operations, created lazily so the
+# size can come from settings. Using a separate pool prevents database
+# I/O from competing with other async tasks.
+_db_executor: ThreadPoolExecutor | None = None
+
+
+def _get_db_executor() -> ThreadPoolExecutor:
+    global _db_executor
+    if _db_executor is None:
+        from app.core.config import get_settings
+        _db_executor = ThreadPoolExecutor(
+            max_workers=get_settings().DB_POOL_SIZE,
+            thread_name_prefix="supabase_db_"
+        )
+    return _db_executor
+
+# Dedicated process pool for CPU-bound work (e.g. text extraction).
+# Threads don't help here because the work holds the GIL; processes keep
+# heavy parsing from starving request handling and database I/O.
+_cpu_executor = ProcessPoolExecutor(max_workers=os.cpu_count())
 
 T = TypeVar('T')
 
@@ -47,7 +66,7 @@ async def run_db_operation(operation: Callable[[], T]) -> T:
     """
     loop = asyncio.get_event_loop()
     try:
-        return await loop.run_in_executor(_db_executor, operation)
+        return await loop.run_in_executor(_get_db_executor(), operation)
     except Exception as e:
         logger.error(f"Database operation failed: {e}")
         raise
@@ -75,6 +94,26 @@ async def db_select(supabase, table: str, columns: str = "*", **filters) -> Any:
     return await run_db_operation(_execute)
 
 
+async def db_select_eq(supabase, table: str, col: str, value, columns: str = "*") -> Any:
+    """
+    Fast-path SELECT with a single equality filter.
+
+    Builds the query eagerly and hands its bound execute method to the
+    executor, avoiding the per-call closure and filter-dict iteration
+    of the generic db_select.
+    """
+    query = supabase.table(table).select(columns).eq(col, value)
+    return await run_db_operation(query.execute)
+
+
+async def db_select_in(supabase, table: str, col: str, values: list, columns: str = "*") -> Any:
+    """
+    Fast-path SELECT with an IN filter.
+    """
+    query = supabase.table(table).select(columns).in_(col, values)
+    return await run_db_operation(query.execute)
+
+
 async def db_select_single(supabase, table: str, columns: str = "*", **filters) -> Any:
     """
     Async wrapper for SELECT queries expecting a single result.
@@ -151,9 +190,65 @@ async def db_storage_download(supabase, bucket: str, path: str) -> bytes:
     return await run_db_operation(_execute)
 
 
+async def db_storage_download_to_file(supabase, bucket: str, path: str, fileobj, hasher=None) -> int:
+    """
+    Stream a storage object into an open file without ever holding the
+    whole body in memory (the SDK's download() returns one big bytes
+    object). Optionally feeds each chunk to a hashlib hasher so a content
+    hash comes for free with the download. Returns bytes written.
+    """
+    signed = await run_db_operation(
+        lambda: supabase.storage.from_(bucket).create_signed_url(path, 60)
+    )
+    url = signed["signedURL"] if isinstance(signed, dict) else signed
+
+    total = 0
+    async with httpx.AsyncClient() as client:
+        async with client.stream("GET", url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                fileobj.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+                total += len(chunk)
+    return total
+
+
+async def run_cpu_task(fn: Callable[..., T], *args) -> T:
+    """
+    Run a CPU-bound function in the process pool executor.
+
+    Unlike run_db_operation, this escapes the GIL entirely, so heavy
+    parsing work (PDF/DOCX extraction, etc.) runs in parallel with the
+    event loop instead of stalling it from a thread.
+
+    Args:
+        fn: A picklable (module-level) function
+        *args: Picklable positional arguments
+
+    Returns:
+        The result of the function
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        return await loop.run_in_executor(_cpu_executor, partial(fn, *args))
+    except Exception as e:
+        logger.error(f"CPU task failed: {e}")
+        raise
+
+
 def shutdown_db_executor():
     """
     Shutdown the database executor gracefully.
     Call this when the application is shutting down.
     """
-    _db_executor.shutdown(wait=True)
+    if _db_executor is not None:
+        _db_executor.shutdown(wait=True)
+
+
+def shutdown_cpu_executor():
+    """
+    Shutdown the CPU process pool gracefully.
+    Call this when the application is shutting down.
+    """
+    _cpu_executor.shutdown(wait=True)
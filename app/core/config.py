@@ -9,6 +9,18 @@ class Settings(BaseSettings):
     API_V1_STR: str = "/api/v1"
     PROJECT_NAME: str = "Lynki Backend"
 
+    # Thread pool size for Supabase operations; size to expected
+    # concurrency x typical request latency rather than a hardcoded value
+    DB_POOL_SIZE: int = 20
+
+    # How many document chunks to analyze with Claude concurrently
+    # (bounded to stay within Anthropic rate limits)
+    ANALYSIS_CONCURRENCY: int = 5
+
+    # How many concepts generate questions concurrently per quiz run.
+    # Size to the provider's concurrency quota, not the old hardcoded 3
+    QUIZ_GEN_CONCURRENCY: int = 8
+
     model_config = SettingsConfigDict(env_file=".env", case_sensitive=True)
 
 @lru_cache()
@@ -1,8 +1,29 @@
+from functools import lru_cache
+
+import httpx
 from supabase import create_client, Client
+from supabase.lib.client_options import SyncClientOptions
+
 from app.core.config import get_settings
 
 settings = get_settings()
 
+@lru_cache(maxsize=1)
 def get_supabase() -> Client:
-    # Use Service Role Key to bypass RLS when acting as the system processing files
-    return create_client(settings.SUPABASE_URL, settings.SUPABASE_SERVICE_ROLE_KEY)
+    # Use Service Role Key to bypass RLS when acting as the system processing files.
+    # Cached so every caller shares one client (and its underlying connection pool)
+    # instead of paying client construction + new TCP/TLS sessions per call site.
+    # The explicit httpx client sizes the keep-alive pool for the parallel
+    # generation/save paths and enables HTTP/2, so concurrent PostgREST
+    # requests multiplex over a handful of warm connections instead of
+    # paying a TLS handshake each.
+    shared_http = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+        timeout=httpx.Timeout(60.0, connect=10.0),
+    )
+    return create_client(
+        settings.SUPABASE_URL,
+        settings.SUPABASE_SERVICE_ROLE_KEY,
+        options=SyncClientOptions(httpx_client=shared_http),
+    )
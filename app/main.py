@@ -1,11 +1,36 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from app.core.config import get_settings
+from app.core.supabase import get_supabase
+from app.core.async_db import _get_db_executor, shutdown_db_executor, shutdown_cpu_executor
 from app.api.v1.router import api_router
 
 settings = get_settings()
 
-app = FastAPI(title=settings.PROJECT_NAME, openapi_url=f"{settings.API_V1_STR}/openapi.json")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Initialize shared resources eagerly so the first request doesn't
+    # pay client construction / pool creation cost
+    get_supabase()
+    # Route implicit run_in_executor(None, ...) calls (e.g. Starlette's
+    # run_in_threadpool) through the shared DB pool instead of an extra
+    # per-loop default pool
+    asyncio.get_event_loop().set_default_executor(_get_db_executor())
+    yield
+    shutdown_db_executor()
+    shutdown_cpu_executor()
+
+
+app = FastAPI(
+    title=settings.PROJECT_NAME,
+    openapi_url=f"{settings.API_V1_STR}/openapi.json",
+    default_response_class=ORJSONResponse,  # C-accelerated JSON encoding
+    lifespan=lifespan,
+)
 
 # Set all CORS enabled origins
 app.add_middleware(
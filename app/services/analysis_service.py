@@ -1,10 +1,14 @@
-import json
+import hashlib
 import logging
+import random
 import re
 import asyncio
+import fastjsonschema
+import orjson
+from aiolimiter import AsyncLimiter
 from typing import List, Dict, Any
-from anthropic import AsyncAnthropic, APITimeoutError, APIConnectionError
-from anthropic.types import TextBlock
+from anthropic import APITimeoutError, APIConnectionError, RateLimitError
+from app.core.anthropic_client import get_anthropic
 from app.core.config import get_settings
 from app.core.supabase import get_supabase
 from app.core.async_db import run_db_operation
@@ -17,190 +21,511 @@ MAX_API_RETRIES = 2
 
 logger = logging.getLogger(__name__)
 
+# Sentence boundaries for the fine-grained chunking fallback
+_SENTENCE_SPLIT = re.compile(r'(?<=[.!?])\s+')
+
+# Compiled once at import; validates a chunk's expanded structure in one
+# C-accelerated pass so the merge/save code can trust the shape instead
+# of guarding every field access. Raises a ValueError subclass, which
+# the retry loop already treats as malformed output.
+_validate_topics = fastjsonschema.compile({
+    "type": "object",
+    "properties": {
+        "topics": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string", "minLength": 1},
+                    "concepts": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "name": {"type": "string", "minLength": 1},
+                                "explanation": {"type": "string"},
+                                "source_text": {"type": "string"},
+                            },
+                            "required": ["name", "explanation", "source_text"],
+                        },
+                    },
+                },
+                "required": ["name", "concepts"],
+            },
+        },
+    },
+    "required": ["topics"],
+})
+
+# Client-side requests-per-minute cap, shared across all concurrent
+# chunk analyses in the process so fan-out stays under Anthropic's RPM
+# limit instead of burning calls on 429s.
+_CLAUDE_RPM = 50
+_rate_limiter = AsyncLimiter(_CLAUDE_RPM, 60)
+
+# Rough chars-per-token ratio for English prose, used to size chunks in
+# token terms without a tokenizer dependency or a count-tokens API call.
+# Dense text (code, tables) runs lower, so the chunk budget stays
+# conservative relative to the 200k context.
+_CHARS_PER_TOKEN = 4
+
+# Bump when the prompt or tool schema changes so stale cached analyses
+# aren't reused
+_PROMPT_VERSION = "v3"
+
+# Static across all chunks and documents; kept at module scope and marked
+# as an Anthropic prompt-cache breakpoint so repeat calls reuse the
+# server-side prefix instead of re-processing (and re-billing) it.
+# Output tokens are the slowest, most expensive part of every call, so
+# the schema uses single-letter keys (expanded client-side) and tight
+# length limits instead of verbose field names and an example block.
+_SYSTEM_PROMPT = (
+    "You are an expert educational curriculum designer. "
+    "Analyze this course material section and extract key learning elements.\n\n"
+    "Identify main Topics. For each Topic, list the key Concepts (at most 5 per topic). "
+    "For each Concept: 'n' is its name, 'e' a concise explanation (max 30 words), "
+    "'q' a short supporting quote from the material (max 20 words)."
+)
+
+# Forced tool use makes the model emit the structure as a schema-validated
+# tool input, so the response is a ready dict - no fence stripping,
+# trailing-comma cleanup, or JSON-repair retries.
+_STRUCTURE_TOOL = {
+    "name": "emit_structure",
+    "description": "Record the topics and concepts extracted from the material.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "topics": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "n": {"type": "string", "description": "Topic name"},
+                        "concepts": {
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "n": {"type": "string", "description": "Concept name"},
+                                    "e": {"type": "string", "description": "Concise explanation"},
+                                    "q": {"type": "string", "description": "Supporting quote"},
+                                },
+                                "required": ["n", "e", "q"],
+                            },
+                        },
+                    },
+                    "required": ["n", "concepts"],
+                },
+            },
+        },
+        "required": ["topics"],
+    },
+}
+
 
 class AnalysisService:
     def __init__(self):
         self.supabase = get_supabase()
-        self.client = AsyncAnthropic(api_key=settings.ANTHROPIC_API_KEY)
-        self.model = "claude-3-haiku-20240307"  # Using Haiku for speed/cost
+        self.client = get_anthropic()
+        self.model = "claude-3-5-haiku-latest"  # Using Haiku for speed/cost
 
-    async def analyze_document(self, document_id: str, text: str):
+    async def analyze_document(self, document_id: str, text: str) -> int:
         """
         Analyzes the extracted text to identify topics and concepts using Claude.
         Uses chunking to handle large documents and output token limits.
         All database operations are async to prevent blocking.
+        Returns the number of concepts written for the document.
         """
         if not text or len(text) < 50:
             logger.warning(f"Text too short for analysis: Document {document_id}")
-            return
+            return 0
 
         try:
-            # Chunk the text (smaller chunks = less output = fits in token limit)
-            chunks = self._chunk_text(text, chunk_size=8000)
+            # Chunk the text on a token budget - Claude bills and limits
+            # on tokens, and fewer, larger chunks mean fewer API calls
+            chunks = self._chunk_text(text)
             logger.info(f"Split document {document_id} into {len(chunks)} chunks for analysis.")
 
-            for i, chunk in enumerate(chunks):
-                logger.info(f"Processing chunk {i+1}/{len(chunks)}...")
-                await self._process_chunk(document_id, chunk, i, len(chunks))
+            # Each chunk is an independent Claude call, so process them
+            # concurrently; the semaphore bounds in-flight requests to
+            # respect Anthropic rate limits.
+            semaphore = asyncio.Semaphore(settings.ANALYSIS_CONCURRENCY)
+
+            # Chunks buffer their usage here and it's flushed as a single
+            # llm_logs insert below, instead of one insert per chunk
+            usage_rows: List[Dict[str, Any]] = []
+
+            async def process_with_limit(index: int, chunk: str):
+                async with semaphore:
+                    logger.info(f"Processing chunk {index+1}/{len(chunks)}...")
+                    return await self._process_chunk(document_id, chunk, index, len(chunks), usage_rows)
+
+            results = await asyncio.gather(
+                *(process_with_limit(i, chunk) for i, chunk in enumerate(chunks)),
+                return_exceptions=True
+            )
+
+            await self._flush_usage_logs(usage_rows)
+
+            failures = [r for r in results if isinstance(r, Exception)]
+            if failures:
+                logger.error(f"{len(failures)}/{len(chunks)} chunks failed for document {document_id}")
+                raise failures[0]
+
+            # Chunks only parse; merge their results and flush to the
+            # database in a handful of bulk calls instead of per-topic
+            # round-trips per chunk.
+            merged = self._merge_chunk_results([r for r in results if isinstance(r, dict)])
+            return await self._save_structure(document_id, merged)
 
         except Exception as e:
             logger.error(f"Analysis failed for {document_id}: {str(e)}")
             raise e
 
-    def _chunk_text(self, text: str, chunk_size: int = 8000) -> List[str]:
+    def _chunk_text(self, text: str, max_chunk_tokens: int = 20000) -> List[str]:
         """
         Split text into chunks that respect paragraph boundaries.
         This prevents cutting content mid-sentence and preserves context.
+
+        Sizes are measured in estimated tokens (~4 chars/token for English
+        prose), not characters: 20k tokens sits well under Haiku's 200k
+        context while keeping the extracted structure within the output
+        budget, and packs ~10x more material per call than the old
+        8000-char window.
         """
+        text = text.strip()
+        # Work in character space using the chars-per-token estimate so the
+        # packer stays a simple length counter
+        chunk_size = max_chunk_tokens * _CHARS_PER_TOKEN
         if len(text) <= chunk_size:
             return [text]
 
-        chunks = []
-        current_chunk = ""
+        # Pack paragraphs into a list buffer with a running length counter
+        # and join once per emitted chunk - repeated str += is quadratic.
+        chunks: List[str] = []
+        buffer: List[str] = []
+        buffer_len = 0
 
-        # Split by double newlines (paragraphs) first, then single newlines
-        paragraphs = text.split("\n\n")
+        def flush():
+            nonlocal buffer, buffer_len
+            if buffer:
+                chunks.append("\n\n".join(buffer))
+                buffer = []
+                buffer_len = 0
 
-        for paragraph in paragraphs:
+        # Split by double newlines (paragraphs) first, then single newlines
+        for paragraph in text.split("\n\n"):
             paragraph = paragraph.strip()
             if not paragraph:
                 continue
 
             # If adding this paragraph exceeds the limit
-            if len(current_chunk) + len(paragraph) + 2 > chunk_size:
-                # Save current chunk if it has content
-                if current_chunk.strip():
-                    chunks.append(current_chunk.strip())
+            if buffer_len + len(paragraph) + 2 > chunk_size:
+                flush()
 
                 # If a single paragraph is too long, split by sentences
                 if len(paragraph) > chunk_size:
-                    sentences = self._split_into_sentences(paragraph)
-                    current_chunk = ""
-                    for sentence in sentences:
-                        if len(current_chunk) + len(sentence) + 1 > chunk_size:
-                            if current_chunk.strip():
-                                chunks.append(current_chunk.strip())
-                            current_chunk = sentence
-                        else:
-                            current_chunk += (" " if current_chunk else "") + sentence
-                else:
-                    current_chunk = paragraph
-            else:
-                current_chunk += ("\n\n" if current_chunk else "") + paragraph
+                    sentence_buf: List[str] = []
+                    sentence_len = 0
+                    for sentence in self._split_into_sentences(paragraph):
+                        if sentence_len + len(sentence) + 1 > chunk_size and sentence_buf:
+                            chunks.append(" ".join(sentence_buf))
+                            sentence_buf = []
+                            sentence_len = 0
+                        sentence_buf.append(sentence)
+                        sentence_len += len(sentence) + 1
+                    if sentence_buf:
+                        # Carry the tail forward so following paragraphs pack with it
+                        buffer = [" ".join(sentence_buf)]
+                        buffer_len = len(buffer[0]) + 2
+                    continue
 
-        # Don't forget the last chunk
-        if current_chunk.strip():
-            chunks.append(current_chunk.strip())
+            buffer.append(paragraph)
+            buffer_len += len(paragraph) + 2
 
+        flush()
         return chunks if chunks else [text]
 
     def _split_into_sentences(self, text: str) -> List[str]:
         """Split text into sentences for finer granularity."""
-        sentences = re.split(r'(?<=[.!?])\s+', text)
+        sentences = _SENTENCE_SPLIT.split(text)
         return [s.strip() for s in sentences if s.strip()]
 
-    def _extract_and_clean_json(self, text: str) -> str:
-        """Extract JSON from response and clean common formatting issues."""
-        # Remove markdown code blocks if present
-        text = re.sub(r'^```(?:json)?\s*', '', text, flags=re.MULTILINE)
-        text = re.sub(r'\s*```$', '', text, flags=re.MULTILINE)
+    async def _stream_chunk_analysis(self, user_message: str):
+        """
+        Run one chunk-analysis call using the streaming API, accumulating
+        the tool-input JSON as it arrives. Streaming keeps data flowing
+        over the connection for the whole generation (no long silent wait
+        on one response) and surfaces the final message for
+        usage/stop_reason.
+
+        Returns (final_message, response_text) where response_text is the
+        raw accumulated tool input - only needed for truncation salvage;
+        the complete structure comes off the tool_use block as a dict.
+        """
+        async with self.client.messages.stream(
+            model=self.model,
+            # Output can't exceed the chunk's information density; budget it
+            # from the input size instead of always reserving Haiku's
+            # 8192-token output limit
+            max_tokens=min(8192, max(1000, len(user_message) // 3)),
+            system=[{
+                "type": "text",
+                "text": _SYSTEM_PROMPT,
+                "cache_control": {"type": "ephemeral"}
+            }],
+            tools=[_STRUCTURE_TOOL],
+            tool_choice={"type": "tool", "name": "emit_structure"},
+            messages=[
+                {"role": "user", "content": user_message}
+            ],
+            temperature=0.1
+        ) as stream:
+            parts: List[str] = []
+            async for event in stream:
+                if event.type == "input_json":
+                    parts.append(event.partial_json)
+            message = await stream.get_final_message()
+        return message, "".join(parts)
+
+    def _tool_input(self, message) -> Dict[str, Any]:
+        """Pull the structured tool input dict off the final message."""
+        for block in message.content:
+            if block.type == "tool_use" and isinstance(block.input, dict):
+                return block.input
+        raise ValueError("No tool_use block in response")
+
+    def _partial_parse(self, text: str) -> List[Dict[str, Any]]:
+        """
+        Salvage complete topic objects from truncated JSON.
 
-        # Find JSON object boundaries
-        start_idx = text.find('{')
-        end_idx = text.rfind('}') + 1
+        Walks the text tracking string/escape state and brace depth, and
+        collects every object inside the top-level "topics" array that
+        closed before the truncation point.
+        """
+        start = text.find('"topics"')
+        if start != -1:
+            start = text.find('[', start)
+        if start == -1:
+            return []
+
+        topics: List[Dict[str, Any]] = []
+        depth = 0
+        obj_start = None
+        in_string = False
+        escaped = False
+
+        for i in range(start + 1, len(text)):
+            ch = text[i]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == '\\':
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+                continue
 
-        if start_idx == -1 or end_idx == 0:
-            raise ValueError("No JSON object found in response")
+            if ch == '"':
+                in_string = True
+            elif ch == '{':
+                if depth == 0:
+                    obj_start = i
+                depth += 1
+            elif ch == '}':
+                depth -= 1
+                if depth == 0 and obj_start is not None:
+                    try:
+                        topics.append(orjson.loads(text[obj_start:i + 1]))
+                    except orjson.JSONDecodeError:
+                        pass
+                    obj_start = None
+            elif ch == ']' and depth == 0:
+                # The topics array closed cleanly; nothing was truncated
+                break
+
+        return topics
+
+    def _expand_terse_keys(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Map the short output-schema keys (n/e/q) back to the full field
+        names the rest of the pipeline uses. Tolerates full names too, in
+        case the model ignores the terse schema, and drops entries with
+        no name. The result is checked against _validate_topics.
+        """
+        topics = []
+        for topic_data in data.get("topics", []):
+            if not isinstance(topic_data, dict):
+                continue
+            topic_name = topic_data.get("n") or topic_data.get("name")
+            if not topic_name:
+                logger.warning("Topic missing name, skipping")
+                continue
 
-        json_str = text[start_idx:end_idx]
+            concepts = []
+            for concept in topic_data.get("concepts", []):
+                if not isinstance(concept, dict):
+                    continue
+                concept_name = concept.get("n") or concept.get("name")
+                if not concept_name:
+                    continue
+                concepts.append({
+                    "name": concept_name,
+                    "explanation": concept.get("e") or concept.get("explanation", ""),
+                    "source_text": concept.get("q") or concept.get("source_text", ""),
+                })
 
-        # Fix common JSON issues
-        # Remove trailing commas before closing braces/brackets
-        json_str = re.sub(r',\s*}', '}', json_str)
-        json_str = re.sub(r',\s*]', ']', json_str)
+            topics.append({
+                "name": topic_name,
+                "concepts": concepts
+            })
 
-        return json_str
+        return {"topics": topics}
 
-    async def _process_chunk(self, document_id: str, text_chunk: str, chunk_index: int, total_chunks: int):
-        """Process a single chunk with retry logic."""
-        for attempt in range(MAX_API_RETRIES + 1):
-            try:
-                system_prompt = (
-                    "You are an expert educational curriculum designer. "
-                    "Analyze this course material section and extract key learning elements.\n\n"
-                    "Identify main Topics. For each Topic, list the key Concepts. "
-                    "For each Concept: provide a concise explanation (1-2 sentences) and extract a relevant quote as source_text.\n\n"
-                    "CRITICAL JSON RULES:\n"
-                    "- Output ONLY valid JSON\n"
-                    "- NO markdown code blocks\n"
-                    "- NO trailing commas\n"
-                    "- Keep explanations concise (under 100 words each)\n"
-                    "- Limit to 5-10 concepts per topic maximum\n\n"
-                    "Format: {{\"topics\": [{{\"name\": \"Topic\", \"concepts\": [{{\"name\": \"Concept\", \"explanation\": \"Brief explanation\", \"source_text\": \"Quote\"}}]}}]}}\n\n"
-                    "Example: {{\"topics\": [{{\"name\": \"Machine Learning\", \"concepts\": [{{\"name\": \"Neural Networks\", \"explanation\": \"Computational models inspired by brain structure\", \"source_text\": \"Neural networks consist of interconnected nodes...\"}}]}}]}}"
-                )
+    def _merge_chunk_results(self, results: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Merge per-chunk topic structures into one, combining concepts of
+        topics that appear in multiple chunks. Inputs are already
+        schema-validated, so field access needs no guards.
+        """
+        merged: Dict[str, List[Dict[str, Any]]] = {}
+        for data in results:
+            for topic_data in data["topics"]:
+                merged.setdefault(topic_data["name"], []).extend(topic_data["concepts"])
+        return {"topics": [{"name": name, "concepts": concepts} for name, concepts in merged.items()]}
+
+    def _chunk_cache_key(self, text_chunk: str) -> str:
+        """Content-addressed cache key for a chunk's analysis result."""
+        payload = f"{self.model}|{_PROMPT_VERSION}|{text_chunk}"
+        return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+    async def _get_cached_analysis(self, cache_key: str) -> Dict[str, Any] | None:
+        """Look up a previously parsed structure for an identical chunk (ASYNC)."""
+        try:
+            res = await run_db_operation(
+                lambda: self.supabase.table("llm_response_cache")
+                    .select("topics_json")
+                    .eq("key", cache_key)
+                    .limit(1)
+                    .execute()
+            )
+            if res.data:
+                return res.data[0]["topics_json"]
+        except Exception as e:
+            # Cache problems must never break analysis
+            logger.warning(f"Analysis cache lookup failed: {e}")
+        return None
 
-                user_message = f"Content (Chunk {chunk_index+1}/{total_chunks}):\n\n{text_chunk}"
+    async def _store_cached_analysis(self, cache_key: str, data: Dict[str, Any]):
+        """Store a parsed structure for reuse by identical chunks (ASYNC)."""
+        try:
+            await run_db_operation(
+                lambda: self.supabase.table("llm_response_cache").upsert({
+                    "key": cache_key,
+                    "topics_json": data
+                }).execute()
+            )
+        except Exception as e:
+            logger.warning(f"Failed to store analysis cache entry: {e}")
 
-                # Use asyncio.wait_for for timeout handling
-                response = await asyncio.wait_for(
-                    self.client.messages.create(
-                        model=self.model,
-                        max_tokens=4000,  # Haiku's safe limit
-                        system=system_prompt,
-                        messages=[
-                            {"role": "user", "content": user_message}
-                        ],
-                        temperature=0.1
-                    ),
-                    timeout=CLAUDE_TIMEOUT_SECONDS
-                )
+    @staticmethod
+    def _backoff_delay(attempt: int) -> float:
+        """
+        Full-jitter exponential backoff. Deterministic 2**attempt delays
+        make concurrently failing chunks retry in lockstep and collide
+        again; a random delay in [0, 2**attempt) spreads them out.
+        """
+        return random.uniform(0, 2 ** attempt)
 
-                # Type-safe extraction of text content
-                content_block = response.content[0]
-                if not isinstance(content_block, TextBlock):
-                    raise ValueError(f"Unexpected content type: {type(content_block).__name__}")
+    @staticmethod
+    def _retry_after_seconds(error: RateLimitError) -> float:
+        """Honor the server's Retry-After header when one is present."""
+        try:
+            return float(error.response.headers.get("retry-after", 0))
+        except (AttributeError, TypeError, ValueError):
+            return 0.0
+
+    async def _process_chunk(self, document_id: str, text_chunk: str, chunk_index: int, total_chunks: int, usage_rows: List[Dict[str, Any]]) -> Dict[str, Any] | None:
+        """Process a single chunk with retry logic. Returns the parsed structure."""
+        # Identical chunks (re-uploads, shared course material) skip the
+        # Claude call entirely
+        cache_key = self._chunk_cache_key(text_chunk)
+        cached = await self._get_cached_analysis(cache_key)
+        if cached is not None:
+            logger.info(f"Chunk {chunk_index+1}/{total_chunks} served from analysis cache")
+            return cached
 
-                response_text = content_block.text
+        for attempt in range(MAX_API_RETRIES + 1):
+            try:
+                user_message = f"Content (Chunk {chunk_index+1}/{total_chunks}):\n\n{text_chunk}"
 
-                # Check if response was truncated
+                # Use asyncio.wait_for for timeout handling; the shared
+                # limiter spaces out request starts across all chunks
+                async with _rate_limiter:
+                    response, response_text = await asyncio.wait_for(
+                        self._stream_chunk_analysis(user_message),
+                        timeout=CLAUDE_TIMEOUT_SECONDS
+                    )
+
+                # Forced tool use returns the structure as a validated
+                # dict - no text parsing or cleanup. A truncated response
+                # (max_tokens) still carries complete topic objects up to
+                # the cut-off in the raw tool-input JSON; salvage those
+                # rather than burning a retry on the whole chunk.
                 if response.stop_reason == "max_tokens":
                     logger.warning(f"Chunk {chunk_index+1} hit token limit. Response may be truncated.")
+                    try:
+                        data = self._expand_terse_keys(self._tool_input(response))
+                    except ValueError:
+                        salvaged = self._partial_parse(response_text)
+                        if not salvaged:
+                            raise
+                        logger.info(f"Salvaged {len(salvaged)} complete topics from truncated chunk {chunk_index+1}")
+                        data = self._expand_terse_keys({"topics": salvaged})
+                else:
+                    data = self._expand_terse_keys(self._tool_input(response))
 
-                # Clean and extract JSON
-                json_str = self._extract_and_clean_json(response_text)
-                data = json.loads(json_str)
+                # One compiled-schema pass; everything downstream (merge,
+                # save, cache) trusts the shape from here on
+                _validate_topics(data)
 
-                # Save to Database (ASYNC - uses run_db_operation)
-                await self._save_structure(document_id, data)
+                # Buffer usage; one bulk insert happens per document
+                self._record_usage(usage_rows, document_id, "structure_extraction_chunk", response.usage)
 
-                # Log Usage (ASYNC)
-                await self._log_usage(document_id, "structure_extraction_chunk", response.usage)
+                await self._store_cached_analysis(cache_key, data)
 
                 logger.info(f"Chunk {chunk_index+1}/{total_chunks} processed successfully")
-                break  # Success
+                return data
 
             except asyncio.TimeoutError:
                 logger.error(f"Attempt {attempt+1}: Claude API timeout after {CLAUDE_TIMEOUT_SECONDS}s for chunk {chunk_index+1}")
                 if attempt < MAX_API_RETRIES:
                     logger.info(f"Retrying chunk {chunk_index+1} after timeout...")
-                    await asyncio.sleep(2 ** attempt)  # Exponential backoff: 1s, 2s, 4s
+                    await asyncio.sleep(self._backoff_delay(attempt))
                 else:
                     logger.error(f"Failed to process chunk {chunk_index+1} after {MAX_API_RETRIES+1} attempts due to timeouts")
                     # Don't raise - continue with other chunks
 
+            except RateLimitError as e:
+                logger.warning(f"Attempt {attempt+1}: Rate limited on chunk {chunk_index+1}")
+                if attempt < MAX_API_RETRIES:
+                    await asyncio.sleep(self._backoff_delay(attempt) + self._retry_after_seconds(e))
+                else:
+                    logger.error(f"Failed to process chunk {chunk_index+1} after {MAX_API_RETRIES+1} attempts due to rate limits")
+
             except (APITimeoutError, APIConnectionError) as e:
                 logger.error(f"Attempt {attempt+1}: Claude API connection error for chunk {chunk_index+1}: {e}")
                 if attempt < MAX_API_RETRIES:
                     logger.info(f"Retrying chunk {chunk_index+1} after connection error...")
-                    await asyncio.sleep(2 ** attempt)
+                    await asyncio.sleep(self._backoff_delay(attempt))
                 else:
                     logger.error(f"Failed to process chunk {chunk_index+1} after {MAX_API_RETRIES+1} attempts")
 
-            except json.JSONDecodeError as e:
-                logger.error(f"Attempt {attempt+1}: Failed to parse JSON from Claude: {e}")
+            except ValueError as e:
+                logger.error(f"Attempt {attempt+1}: Malformed structure from Claude: {e}")
                 if attempt < MAX_API_RETRIES:
-                    logger.info(f"Retrying chunk {chunk_index+1} due to JSON error...")
+                    logger.info(f"Retrying chunk {chunk_index+1} due to malformed output...")
                 else:
                     logger.error(f"Failed to process chunk {chunk_index+1} after {MAX_API_RETRIES+1} attempts.")
 
@@ -208,90 +533,91 @@ class AnalysisService:
                 logger.error(f"Unexpected error processing chunk {chunk_index+1}: {e}")
                 raise e
 
-    async def _save_structure(self, document_id: str, data: Dict[str, Any]):
-        """Save extracted topics and concepts to database (ASYNC)."""
-        topics = data.get("topics", [])
+        return None
 
-        for topic_data in topics:
-            topic_name = topic_data.get("name")
-            if not topic_name:
-                logger.warning("Topic missing 'name' field, skipping")
-                continue
+    # Insert concepts at most this many rows per call to keep payloads bounded
+    _CONCEPT_INSERT_BATCH = 1000
 
-            # 1. Check if topic already exists for this document (ASYNC)
-            existing_topic = await run_db_operation(
-                lambda tn=topic_name: self.supabase.table("topics")
-                    .select("id")
-                    .eq("document_id", document_id)
-                    .eq("name", tn)
-                    .execute()
-            )
-
-            topic_id = None
-            if existing_topic.data and isinstance(existing_topic.data, list) and len(existing_topic.data) > 0:
-                first_topic = existing_topic.data[0]
-                if isinstance(first_topic, dict) and "id" in first_topic:
-                    topic_id = first_topic["id"]
+    async def _save_structure(self, document_id: str, data: Dict[str, Any]) -> int:
+        """
+        Save extracted topics and concepts to database (ASYNC).
 
+        Expects the merged structure for the whole document and writes it
+        in bulk: one topic upsert returning ids, then batched concept
+        inserts - instead of per-topic round-trips. Returns the number of
+        concepts written, so callers don't need a follow-up count query.
+        """
+        topics = data.get("topics", [])
+        topic_names = [t["name"] for t in topics]
+        if not topic_names:
+            return 0
+
+        # 1. Write all topics in one upsert and read the ids straight off
+        # the returned representation. ON CONFLICT (document_id, name)
+        # makes this idempotent and race-safe under concurrent analyses
+        # (backed by the unique index in db/indexes.sql), and PostgREST
+        # returns existing rows' ids on conflict, so no prior SELECT is
+        # needed.
+        topic_res = await run_db_operation(
+            lambda: self.supabase.table("topics").upsert(
+                [{"document_id": document_id, "name": name} for name in topic_names],
+                on_conflict="document_id,name",
+            ).execute()
+        )
+
+        topic_ids: Dict[str, Any] = {}
+        for row in (topic_res.data or []):
+            if isinstance(row, dict) and "id" in row:
+                topic_ids[row["name"]] = row["id"]
+
+        # 2. Flatten all concepts across topics and insert in batches (ASYNC)
+        concept_rows = []
+        for topic_data in topics:
+            topic_id = topic_ids.get(topic_data["name"])
             if not topic_id:
-                # Insert New Topic (ASYNC)
-                topic_res = await run_db_operation(
-                    lambda tn=topic_name: self.supabase.table("topics").insert({
-                        "document_id": document_id,
-                        "name": tn
-                    }).execute()
-                )
-
-                if topic_res.data and isinstance(topic_res.data, list) and len(topic_res.data) > 0:
-                    first_new_topic = topic_res.data[0]
-                    if isinstance(first_new_topic, dict) and "id" in first_new_topic:
-                        topic_id = first_new_topic["id"]
-
-                if not topic_id:
-                    logger.warning(f"Failed to insert topic: {topic_name}")
-                    continue
-
-            # Insert Concepts (ASYNC)
-            concepts = topic_data.get("concepts", [])
-            if not concepts or not isinstance(concepts, list):
+                logger.warning(f"Failed to resolve topic: {topic_data['name']}")
                 continue
 
-            concept_rows = []
-            for concept in concepts:
-                if not isinstance(concept, dict):
-                    continue
-
-                concept_name = concept.get("name")
-                if not concept_name:
-                    continue
-
+            # Concepts passed schema validation, so the fields are present
+            for concept in topic_data["concepts"]:
                 concept_rows.append({
                     "topic_id": topic_id,
-                    "name": concept_name,
-                    "explanation": concept.get("explanation", ""),
-                    "source_text": concept.get("source_text", ""),
+                    "name": concept["name"],
+                    "explanation": concept["explanation"],
+                    "source_text": concept["source_text"],
                     "complexity_level": "intermediate"
                 })
 
-            if concept_rows:
-                try:
-                    await run_db_operation(
-                        lambda rows=concept_rows: self.supabase.table("concepts").insert(rows).execute()
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to insert concepts for topic {topic_name}: {e}")
-
-    async def _log_usage(self, document_id: str, operation: str, usage: Any):
-        """Log API usage to database (ASYNC)."""
+        concepts_written = 0
+        for start in range(0, len(concept_rows), self._CONCEPT_INSERT_BATCH):
+            batch = concept_rows[start:start + self._CONCEPT_INSERT_BATCH]
+            try:
+                await run_db_operation(
+                    lambda rows=batch: self.supabase.table("concepts").insert(rows).execute()
+                )
+                concepts_written += len(batch)
+            except Exception as e:
+                logger.error(f"Failed to insert concept batch for document {document_id}: {e}")
+
+        return concepts_written
+
+    def _record_usage(self, usage_rows: List[Dict[str, Any]], document_id: str, operation: str, usage: Any):
+        """Buffer one call's usage; flushed in bulk by _flush_usage_logs."""
+        usage_rows.append({
+            "document_id": document_id,
+            "operation": operation,
+            "model": self.model,
+            "input_tokens": usage.input_tokens,
+            "output_tokens": usage.output_tokens
+        })
+
+    async def _flush_usage_logs(self, usage_rows: List[Dict[str, Any]]):
+        """Write all buffered usage rows in one insert (ASYNC)."""
+        if not usage_rows:
+            return
         try:
             await run_db_operation(
-                lambda: self.supabase.table("llm_logs").insert({
-                    "document_id": document_id,
-                    "operation": operation,
-                    "model": self.model,
-                    "input_tokens": usage.input_tokens,
-                    "output_tokens": usage.output_tokens
-                }).execute()
+                lambda: self.supabase.table("llm_logs").insert(usage_rows).execute()
             )
         except Exception as e:
             # Don't fail the whole process if logging fails
@@ -1,27 +1,118 @@
-import json
 import logging
 import re
 import asyncio
+import orjson
+from functools import lru_cache
 from typing import List, Dict, Any, Tuple
-from anthropic import AsyncAnthropic, APITimeoutError, APIConnectionError
+from anthropic import APITimeoutError, APIConnectionError
 from anthropic.types import TextBlock
-from app.core.config import get_settings
+from app.core.anthropic_client import get_anthropic
 from app.schemas.quiz import GeneratedQuestion, QuestionOption
 
-settings = get_settings()
-
 # Timeout configuration
 CLAUDE_TIMEOUT_SECONDS = 90  # 90 seconds for Sonnet question generation (more complex)
 MAX_API_RETRIES = 2
 
+# Prompt blocks shared by the batch and single-question system prompts
+_DIFFICULTY_GUIDES = {
+    "easy": (
+        "EASY questions test basic recall and understanding.\n"
+        "- Focus on definitions, key terms, and fundamental concepts\n"
+        "- Straightforward language\n"
+        "- Direct questions with clear answers"
+    ),
+    "medium": (
+        "MEDIUM questions test comprehension and application.\n"
+        "- Require understanding concepts, not just memorization\n"
+        "- Apply knowledge to similar scenarios\n"
+        "- Connect related ideas"
+    ),
+    "hard": (
+        "HARD questions test analysis, evaluation, and synthesis.\n"
+        "- Require deep understanding and critical thinking\n"
+        "- Apply concepts to novel situations\n"
+        "- Analyze relationships and make judgments"
+    )
+}
+
+_QUALITY_REQUIREMENTS = """CRITICAL QUALITY REQUIREMENTS:
+1. **Clear and Unambiguous**: Question should have ONE definitively correct answer
+2. **Exam-Ready**: Written at the level of professional certification or university exams
+3. **Grounded in Source**: Use the actual content from the provided material
+4. **Realistic Distractors**: Wrong answers should be plausible but clearly incorrect
+5. **Educational Value**: Test meaningful understanding, not trivial details"""
+
+_QUESTION_JSON_SCHEMA = """{
+  "question": "Clear, specific question text (no vague wording)",
+  "options": [
+    {
+      "text": "Option A text",
+      "is_correct": true,
+      "explanation": "Detailed explanation of why this is correct, referencing source material"
+    },
+    {
+      "text": "Option B text",
+      "is_correct": false,
+      "explanation": "Specific explanation of why this is incorrect and what misconception it represents"
+    },
+    {
+      "text": "Option C text",
+      "is_correct": false,
+      "explanation": "Specific explanation of why this is incorrect"
+    },
+    {
+      "text": "Option D text",
+      "is_correct": false,
+      "explanation": "Specific explanation of why this is incorrect"
+    }
+  ],
+  "hint": "Subtle hint that guides thinking without revealing the answer"
+}"""
+
+# Response-cleanup patterns, compiled once. The earlier inline literals
+# were double-escaped (r'\\s' matched a literal backslash, not
+# whitespace), so fence stripping and comma cleanup silently never ran.
+_CODE_FENCE_OPEN = re.compile(r'^```(?:json)?\s*', re.MULTILINE)
+_CODE_FENCE_CLOSE = re.compile(r'\s*```$', re.MULTILINE)
+_TRAILING_COMMA_BRACE = re.compile(r',\s*}')
+_TRAILING_COMMA_BRACKET = re.compile(r',\s*]')
+
+# Bounds concurrent single-question calls across all concepts so the
+# fallback fan-out respects Anthropic rate limits
+_QUESTION_CONCURRENCY = asyncio.Semaphore(5)
+
+_OUTPUT_RULES = """RULES:
+- EXACTLY 4 options (A, B, C, D)
+- EXACTLY 1 correct answer
+- NO "All of the above" or "None of the above"
+- NO "Both A and B" compound options
+- Each explanation must be 1-3 sentences
+- Hint should prompt reflection, not give away the answer
+- Output ONLY valid JSON, no markdown formatting"""
+
+# The invariant bulk of the system prompt. Sent as the first system
+# block with a cache_control breakpoint so Anthropic's prompt cache
+# reuses the prefix across every question call; only the short
+# difficulty-specific block after it varies.
+_STATIC_SYSTEM_PROMPT = f"""You are an expert educational assessment designer specializing in creating high-quality exam questions.
+
+{_QUALITY_REQUIREMENTS}
+
+OUTPUT FORMAT (MUST be valid JSON):
+{_QUESTION_JSON_SCHEMA}
+
+{_OUTPUT_RULES}"""
+
 class QuestionGenerator:
     """
     Generates high-quality exam questions using Claude Sonnet.
     Focuses on Bloom's Taxonomy levels and real exam scenarios.
     """
-    
+
+    __slots__ = ("client", "model")
+
     def __init__(self):
-        self.client = AsyncAnthropic(api_key=settings.ANTHROPIC_API_KEY)
+        self.client = get_anthropic()
         self.model = "claude-sonnet-4-20250514"  # Latest Sonnet for quality
         
     async def generate_questions_for_concept(
@@ -48,55 +139,156 @@ class QuestionGenerator:
         try:
             # Determine difficulty distribution based on number of questions
             difficulties = self._get_difficulty_distribution(num_questions)
-            
+
             logging.info(f"Generating {num_questions} questions for concept: {concept_name}")
-            
-            questions = []
-            for i, difficulty in enumerate(difficulties):
-                question = await self._generate_single_question(
-                    concept_id=concept_id,
-                    concept_name=concept_name,
-                    concept_explanation=concept_explanation,
-                    source_text=source_text,
-                    difficulty=difficulty,
-                    question_number=i + 1,
-                    total_questions=num_questions
+
+            # Window the source material once per concept instead of
+            # slicing inside every prompt build, and keep only the window
+            # alive in the coroutine frames below
+            source_text = self._window_source_text(source_text, concept_name)
+
+            # One call for the whole concept amortizes TTFT and shares the
+            # source-material tokens across all questions; the per-question
+            # path remains as a fallback when the batch fails
+            questions = await self._generate_question_batch(
+                concept_id=concept_id,
+                concept_name=concept_name,
+                concept_explanation=concept_explanation,
+                source_text=source_text,
+                difficulties=difficulties
+            )
+
+            if questions is None:
+                logging.info(f"Falling back to per-question generation for {concept_name}")
+                # Each question is an independent call, so overlap them;
+                # the module-level semaphore keeps total in-flight
+                # requests bounded across concepts
+                results = await asyncio.gather(
+                    *(self._generate_single_question(
+                        concept_id=concept_id,
+                        concept_name=concept_name,
+                        concept_explanation=concept_explanation,
+                        source_text=source_text,
+                        difficulty=difficulty,
+                        question_number=i + 1,
+                        total_questions=num_questions
+                    ) for i, difficulty in enumerate(difficulties)),
+                    return_exceptions=True
                 )
-                
-                if question:
-                    questions.append(question)
-                    
+                questions = [q for q in results if isinstance(q, GeneratedQuestion)]
+
             logging.info(f"Successfully generated {len(questions)}/{num_questions} questions for {concept_name}")
             return questions
-            
+
         except Exception as e:
             logging.error(f"Failed to generate questions for concept {concept_name}: {e}")
             return []
     
-    def _get_difficulty_distribution(self, num_questions: int) -> List[str]:
+    @staticmethod
+    def _window_source_text(source_text: str, concept_name: str, window: int = 1500) -> str:
+        """
+        Cut the source material down to the window the prompts actually
+        use. Prefers the region around the first mention of the concept
+        over a blind document prefix.
+        """
+        if len(source_text) <= window:
+            return source_text
+
+        idx = source_text.lower().find(concept_name.lower())
+        if idx == -1:
+            return source_text[:window]
+
+        start = max(0, idx - window // 2)
+        return source_text[start:start + window]
+
+    @staticmethod
+    @lru_cache(maxsize=16)
+    def _get_difficulty_distribution(num_questions: int) -> Tuple[str, ...]:
         """
         Determine difficulty distribution based on number of questions.
-        Ensures balanced coverage across difficulty levels.
+        Ensures balanced coverage across difficulty levels. Pure function
+        of the count, so results are memoized (hence the tuple return).
         """
         if num_questions == 1:
-            return ["medium"]
+            return ("medium",)
         elif num_questions == 2:
-            return ["easy", "hard"]
+            return ("easy", "hard")
         elif num_questions == 3:
-            return ["easy", "medium", "hard"]
+            return ("easy", "medium", "hard")
         elif num_questions == 4:
-            return ["easy", "medium", "medium", "hard"]
+            return ("easy", "medium", "medium", "hard")
         elif num_questions == 5:
-            return ["easy", "easy", "medium", "hard", "hard"]
+            return ("easy", "easy", "medium", "hard", "hard")
         else:
             # For 6+ questions, distribute evenly
             easy_count = num_questions // 3
             hard_count = num_questions // 3
             medium_count = num_questions - easy_count - hard_count
-            return (["easy"] * easy_count + 
-                   ["medium"] * medium_count + 
-                   ["hard"] * hard_count)
+            return (("easy",) * easy_count +
+                    ("medium",) * medium_count +
+                    ("hard",) * hard_count)
     
+    async def _generate_question_batch(
+        self,
+        concept_id: str,
+        concept_name: str,
+        concept_explanation: str,
+        source_text: str,
+        difficulties: Tuple[str, ...]
+    ) -> List[GeneratedQuestion] | None:
+        """
+        Generate all of a concept's questions in one Claude call.
+
+        Returns the validated questions, or None when the call or parse
+        fails entirely so the caller can fall back to per-question
+        generation (which carries its own retries).
+        """
+        try:
+            response = await asyncio.wait_for(
+                self.client.messages.create(
+                    model=self.model,
+                    max_tokens=2000 * len(difficulties),
+                    system=self._build_batch_system_prompt(difficulties),
+                    messages=[{
+                        "role": "user",
+                        "content": self._build_batch_user_message(
+                            concept_name=concept_name,
+                            concept_explanation=concept_explanation,
+                            source_text=source_text,
+                            difficulties=difficulties
+                        )
+                    }],
+                    temperature=0.3
+                ),
+                timeout=CLAUDE_TIMEOUT_SECONDS
+            )
+
+            content_block = response.content[0]
+            if not isinstance(content_block, TextBlock):
+                raise ValueError(f"Unexpected content type: {type(content_block).__name__}")
+
+            data = self._parse_question_response(content_block.text)
+            if isinstance(data, dict):
+                data = [data]
+
+            questions = []
+            for question_data, difficulty in zip(data, difficulties):
+                try:
+                    question = self._create_question_object(question_data, concept_id, difficulty)
+                except (KeyError, ValueError) as e:
+                    logging.warning(f"Skipping malformed batched question for {concept_name}: {e}")
+                    continue
+                if self._validate_question_quality(question):
+                    questions.append(question)
+
+            # An empty result means the batch was unusable; let the
+            # fallback path try question by question
+            return questions or None
+
+        except Exception as e:
+            logging.warning(f"Batched generation failed for {concept_name}: {e}")
+            return None
+
     async def _generate_single_question(
         self,
         concept_id: str,
@@ -121,16 +313,17 @@ class QuestionGenerator:
                 )
 
                 # Use asyncio.wait_for for timeout handling
-                response = await asyncio.wait_for(
-                    self.client.messages.create(
-                        model=self.model,
-                        max_tokens=2000,
-                        system=system_prompt,
-                        messages=[{"role": "user", "content": user_message}],
-                        temperature=0.3  # Balance creativity and consistency
-                    ),
-                    timeout=CLAUDE_TIMEOUT_SECONDS
-                )
+                async with _QUESTION_CONCURRENCY:
+                    response = await asyncio.wait_for(
+                        self.client.messages.create(
+                            model=self.model,
+                            max_tokens=2000,
+                            system=system_prompt,
+                            messages=[{"role": "user", "content": user_message}],
+                            temperature=0.3  # Balance creativity and consistency
+                        ),
+                        timeout=CLAUDE_TIMEOUT_SECONDS
+                    )
                 
                 # Extract text content
                 content_block = response.content[0]
@@ -163,7 +356,7 @@ class QuestionGenerator:
                     await asyncio.sleep(2 ** attempt)
                     continue
 
-            except json.JSONDecodeError as e:
+            except orjson.JSONDecodeError as e:
                 logging.error(f"JSON parsing error (attempt {attempt + 1}): {e}")
                 if attempt < MAX_API_RETRIES:
                     continue
@@ -175,79 +368,47 @@ class QuestionGenerator:
 
         return None
     
-    def _build_system_prompt(self, difficulty: str) -> str:
-        """Build the system prompt for question generation."""
-        difficulty_guides = {
-            "easy": (
-                "EASY questions test basic recall and understanding.\n"
-                "- Focus on definitions, key terms, and fundamental concepts\n"
-                "- Straightforward language\n"
-                "- Direct questions with clear answers"
-            ),
-            "medium": (
-                "MEDIUM questions test comprehension and application.\n"
-                "- Require understanding concepts, not just memorization\n"
-                "- Apply knowledge to similar scenarios\n"
-                "- Connect related ideas"
-            ),
-            "hard": (
-                "HARD questions test analysis, evaluation, and synthesis.\n"
-                "- Require deep understanding and critical thinking\n"
-                "- Apply concepts to novel situations\n"
-                "- Analyze relationships and make judgments"
-            )
-        }
-        
-        return f"""You are an expert educational assessment designer specializing in creating high-quality exam questions.
+    def _build_system_prompt(self, difficulty: str) -> List[Dict[str, Any]]:
+        """System blocks for single-question generation (cached static prefix + task)."""
+        return self._system_blocks(self._single_task_text(difficulty))
+
+    def _build_batch_system_prompt(self, difficulties: Tuple[str, ...]) -> List[Dict[str, Any]]:
+        """System blocks for one call covering all of a concept's questions."""
+        return self._system_blocks(self._batch_task_text(difficulties))
 
-Your task is to create ONE multiple-choice question based on the provided concept and source material.
+    # The task texts are pure functions of a handful of difficulty
+    # combinations, so memoize them instead of re-rendering the same
+    # f-strings on every question call. Only the strings are cached -
+    # the block lists are rebuilt so callers never share mutable state.
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def _single_task_text(difficulty: str) -> str:
+        return f"""Your task is to create ONE multiple-choice question based on the provided concept and source material.
 
 DIFFICULTY LEVEL: {difficulty.upper()}
-{difficulty_guides[difficulty]}
+{_DIFFICULTY_GUIDES[difficulty]}"""
 
-CRITICAL QUALITY REQUIREMENTS:
-1. **Clear and Unambiguous**: Question should have ONE definitively correct answer
-2. **Exam-Ready**: Written at the level of professional certification or university exams
-3. **Grounded in Source**: Use the actual content from the provided material
-4. **Realistic Distractors**: Wrong answers should be plausible but clearly incorrect
-5. **Educational Value**: Test meaningful understanding, not trivial details
+    @staticmethod
+    @lru_cache(maxsize=16)
+    def _batch_task_text(difficulties: Tuple[str, ...]) -> str:
+        guides = "\n\n".join(_DIFFICULTY_GUIDES[d] for d in dict.fromkeys(difficulties))
+        return f"""Your task is to create {len(difficulties)} multiple-choice questions based on the provided concept and source material, with these difficulty levels in this exact order: {", ".join(difficulties)}.
 
-OUTPUT FORMAT (MUST be valid JSON):
-{{
-  "question": "Clear, specific question text (no vague wording)",
-  "options": [
-    {{
-      "text": "Option A text",
-      "is_correct": true,
-      "explanation": "Detailed explanation of why this is correct, referencing source material"
-    }},
-    {{
-      "text": "Option B text",
-      "is_correct": false,
-      "explanation": "Specific explanation of why this is incorrect and what misconception it represents"
-    }},
-    {{
-      "text": "Option C text",
-      "is_correct": false,
-      "explanation": "Specific explanation of why this is incorrect"
-    }},
-    {{
-      "text": "Option D text",
-      "is_correct": false,
-      "explanation": "Specific explanation of why this is incorrect"
-    }}
-  ],
-  "hint": "Subtle hint that guides thinking without revealing the answer"
-}}
+{guides}
 
-RULES:
-- EXACTLY 4 options (A, B, C, D)
-- EXACTLY 1 correct answer
-- NO "All of the above" or "None of the above"
-- NO "Both A and B" compound options
-- Each explanation must be 1-3 sentences
-- Hint should prompt reflection, not give away the answer
-- Output ONLY valid JSON, no markdown formatting"""
+Output a JSON array of exactly {len(difficulties)} question objects in the requested difficulty order, each in the OUTPUT FORMAT schema."""
+
+    @staticmethod
+    def _system_blocks(task_text: str) -> List[Dict[str, Any]]:
+        """Static cached prefix first, short task-specific block second."""
+        return [
+            {
+                "type": "text",
+                "text": _STATIC_SYSTEM_PROMPT,
+                "cache_control": {"type": "ephemeral"}
+            },
+            {"type": "text", "text": task_text},
+        ]
     
     def _build_user_message(
         self,
@@ -267,30 +428,61 @@ CONCEPT EXPLANATION:
 {concept_explanation}
 
 SOURCE MATERIAL:
-{source_text[:1500]}
+{source_text}
 
 Generate ONE high-quality {difficulty}-level multiple-choice question that tests this concept."""
-    
-    def _parse_question_response(self, response_text: str) -> Dict[str, Any]:
-        """Parse and clean the JSON response."""
+
+    def _build_batch_user_message(
+        self,
+        concept_name: str,
+        concept_explanation: str,
+        source_text: str,
+        difficulties: Tuple[str, ...]
+    ) -> str:
+        """Build the user message for a whole-concept batch."""
+        return f"""Create {len(difficulties)} questions with these difficulties in order: {", ".join(difficulties)}.
+
+CONCEPT: {concept_name}
+
+CONCEPT EXPLANATION:
+{concept_explanation}
+
+SOURCE MATERIAL:
+{source_text}
+
+Generate the {len(difficulties)} high-quality multiple-choice questions as a JSON array."""
+
+    def _parse_question_response(self, response_text: str) -> Dict[str, Any] | List[Dict[str, Any]]:
+        """Parse and clean the JSON response (a single object or an array)."""
         # Remove markdown code blocks if present
-        response_text = re.sub(r'^```(?:json)?\\s*', '', response_text, flags=re.MULTILINE)
-        response_text = re.sub(r'\\s*```$', '', response_text, flags=re.MULTILINE)
-        
-        # Find JSON boundaries
-        start_idx = response_text.find('{')
-        end_idx = response_text.rfind('}') + 1
-        
-        if start_idx == -1 or end_idx == 0:
+        response_text = _CODE_FENCE_OPEN.sub('', response_text)
+        response_text = _CODE_FENCE_CLOSE.sub('', response_text)
+
+        # Find JSON boundaries; batch responses are arrays, single ones
+        # objects. Only trust the array branch when its closing bracket
+        # follows the last object brace - a stray '[' in leading prose
+        # (e.g. "[easy]") must not swallow a lone object - and fall back
+        # to object extraction if the array slice fails to parse.
+        obj_idx = response_text.find('{')
+        obj_end = response_text.rfind('}')
+        arr_idx = response_text.find('[')
+        arr_end = response_text.rfind(']')
+        if arr_idx != -1 and (obj_idx == -1 or arr_idx < obj_idx) and arr_end > obj_end:
+            try:
+                return self._clean_and_load(response_text[arr_idx:arr_end + 1])
+            except orjson.JSONDecodeError:
+                pass
+
+        if obj_idx == -1 or obj_end == -1:
             raise ValueError("No JSON object found in response")
-        
-        json_str = response_text[start_idx:end_idx]
-        
-        # Clean common JSON issues
-        json_str = re.sub(r',\\s*}', '}', json_str)
-        json_str = re.sub(r',\\s*]', ']', json_str)
-        
-        return json.loads(json_str)
+        return self._clean_and_load(response_text[obj_idx:obj_end + 1])
+
+    @staticmethod
+    def _clean_and_load(json_str: str) -> Dict[str, Any] | List[Dict[str, Any]]:
+        """Strip common JSON issues (trailing commas) and parse."""
+        json_str = _TRAILING_COMMA_BRACE.sub('}', json_str)
+        json_str = _TRAILING_COMMA_BRACKET.sub(']', json_str)
+        return orjson.loads(json_str)
     
     def _create_question_object(
         self,
@@ -336,21 +528,23 @@ Generate ONE high-quality {difficulty}-level multiple-choice question that tests
             logging.warning(f"Question text length invalid: {len(question.question)}")
             return False
         
-        # Check all options have text
+        # One pass over the options: length checks plus a duplicate check
+        # on normalized (stripped, lowercased) text so "Paris " and
+        # "paris" count as the same option
+        seen = set()
         for opt in question.options:
-            if not opt.option_text or len(opt.option_text) < 3:
+            text = opt.option_text.strip().lower() if opt.option_text else ""
+            if len(text) < 3:
                 logging.warning("Option text too short or empty")
                 return False
             if not opt.explanation or len(opt.explanation) < 10:
                 logging.warning("Option explanation too short or empty")
                 return False
-        
-        # Check options are not too similar (basic check)
-        option_texts = [opt.option_text.lower() for opt in question.options]
-        if len(set(option_texts)) != len(option_texts):
-            logging.warning("Duplicate options detected")
-            return False
-        
+            if text in seen:
+                logging.warning("Duplicate options detected")
+                return False
+            seen.add(text)
+
         # Check hint exists and is reasonable
         if question.hint and len(question.hint) < 10:
             logging.warning("Hint too short")
@@ -1,16 +1,37 @@
+import hashlib
 import logging
 import asyncio
 import random
-from typing import List, Dict, Any, Optional, Tuple
+from typing import AsyncIterator, List, Dict, Any, Optional, Tuple
+from postgrest import ReturnMethod
+from app.core.config import get_settings
 from app.core.supabase import get_supabase
 from app.core.async_db import run_db_operation
 from app.services.question_generator import QuestionGenerator
-from app.schemas.quiz import GeneratedQuestion
+from app.schemas.quiz import GeneratedQuestion, QuestionOption
 
 logger = logging.getLogger(__name__)
 
-# Concurrency limit for parallel question generation
-MAX_CONCURRENT_GENERATIONS = 3
+settings = get_settings()
+
+# Concurrency limit for parallel question generation, sized via settings
+# to the LLM provider's quota rather than a hardcoded constant
+MAX_CONCURRENT_GENERATIONS = settings.QUIZ_GEN_CONCURRENCY
+
+# Bump when the question-generation prompts change so stale cached
+# questions aren't reused
+_QUESTION_PROMPT_VERSION = "v1"
+
+# Caps parallel per-question saves in the fallback path so one big quiz
+# can't monopolize the DB thread pool
+_SAVE_CONCURRENCY = asyncio.Semaphore(10)
+
+# Short-lived document lookups cache: bursty retries and duplicate
+# webhook deliveries re-fetch the same row within seconds, and a 30s TTL
+# is well under any status transition a caller could observe
+_DOC_CACHE_TTL_SECONDS = 30.0
+_DOC_CACHE_MAX_ENTRIES = 1024
+_doc_cache: Dict[str, Tuple[Dict[str, Any], float]] = {}
 
 
 class QuizGenerationService:
@@ -20,9 +41,40 @@ class QuizGenerationService:
     All database operations are async to prevent blocking.
     """
 
+    # Client and generator are process-global state; they live on the
+    # class and are built once on first use, so constructing the service
+    # in request/worker hot paths is just an allocation
+    _supabase = None
+    _question_generator: Optional[QuestionGenerator] = None
+
     def __init__(self):
-        self.supabase = get_supabase()
-        self.question_generator = QuestionGenerator()
+        cls = type(self)
+        if cls._supabase is None:
+            cls._supabase = get_supabase()
+            cls._question_generator = QuestionGenerator()
+        # In-flight concept prefetches keyed by document id (see prefetch)
+        self._prefetch: Dict[str, "asyncio.Task"] = {}
+
+    @property
+    def supabase(self):
+        return type(self)._supabase
+
+    @property
+    def question_generator(self) -> QuestionGenerator:
+        return type(self)._question_generator
+
+    def prefetch(self, document_id: str) -> None:
+        """
+        Start fetching a document's concepts in the background. A worker
+        draining several documents can call this for the next document
+        while the current one is deep in LLM calls, so the concepts are
+        already in hand when generate_quiz_for_document gets to it.
+        Must be called from a running event loop.
+        """
+        if document_id not in self._prefetch:
+            self._prefetch[document_id] = asyncio.create_task(
+                self._get_document_concepts(document_id)
+            )
 
     async def generate_quiz_for_document(
         self,
@@ -33,6 +85,7 @@ class QuizGenerationService:
     ) -> Optional[str]:
         """
         Generate a complete quiz from a document's extracted concepts.
+        Thin wrapper that drains the streaming generator below.
 
         Args:
             document_id: UUID of the processed document
@@ -43,29 +96,67 @@ class QuizGenerationService:
         Returns:
             quiz_id if successful, None if failed
         """
+        async for event in self.generate_quiz_for_document_stream(
+            document_id=document_id,
+            user_id=user_id,
+            min_questions_per_concept=min_questions_per_concept,
+            max_questions_per_concept=max_questions_per_concept,
+        ):
+            if event["type"] == "completed":
+                return event["quiz_id"]
+        return None
+
+    async def generate_quiz_for_document_stream(
+        self,
+        document_id: str,
+        user_id: str,
+        min_questions_per_concept: int = 2,
+        max_questions_per_concept: int = 5
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Streaming form of quiz generation: yields one event per concept
+        as its questions finish, so SSE/WebSocket handlers can push
+        partial progress long before the full quiz is done.
+
+        Events are dicts with a "type" key:
+            {"type": "concept", "concept_id", "concept_name",
+             "questions", "progress"} as each concept completes;
+            {"type": "completed", "quiz_id", "total_questions",
+             "failed_concepts"} on success; or
+            {"type": "failed", "quiz_id"} terminally on failure.
+        """
         quiz_id = None
         try:
             logger.info(f"Starting quiz generation for document {document_id}")
 
-            # 1. Verify document exists and is completed (ASYNC)
-            doc = await self._get_document(document_id)
+            # 1. Fetch the document and its concepts together - the two
+            # queries are independent, so their round-trips overlap. A
+            # prefetch kicked off during an earlier document's generation
+            # may already have the concepts in flight (ASYNC)
+            prefetched = self._prefetch.pop(document_id, None)
+            doc, concepts = await asyncio.gather(
+                self._get_document(document_id),
+                prefetched if prefetched is not None else self._get_document_concepts(document_id)
+            )
+
             if not doc:
                 logger.error(f"Document {document_id} not found")
-                return None
+                yield {"type": "failed", "quiz_id": None}
+                return
 
             if doc.get("status") != "completed":
                 logger.error(f"Document {document_id} not yet processed")
-                return None
+                yield {"type": "failed", "quiz_id": None}
+                return
 
-            # 2. Get all concepts for this document (ASYNC)
-            concepts = await self._get_document_concepts(document_id)
             if not concepts:
                 logger.warning(f"No concepts found for document {document_id}")
-                return None
+                yield {"type": "failed", "quiz_id": None}
+                return
 
             logger.info(f"Found {len(concepts)} concepts for quiz generation")
 
-            # 3. Create quiz record (ASYNC)
+            # 2. Create quiz record (ASYNC)
             quiz_id = await self._create_quiz(
                 document_id=document_id,
                 user_id=user_id,
@@ -75,33 +166,56 @@ class QuizGenerationService:
 
             if not quiz_id:
                 logger.error("Failed to create quiz record")
-                return None
-
-            # 4. Update status to generating (ASYNC)
-            await self._update_quiz_status(quiz_id, "generating")
-
-            # 5. Generate questions for each concept (in parallel batches)
-            total_questions = 0
-            failed_concepts = []
-
-            logger.info(f"Starting parallel question generation for {len(concepts)} concepts (max {MAX_CONCURRENT_GENERATIONS} concurrent)")
-
-            # Process concepts in parallel batches
-            semaphore = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
-
-            async def process_concept(concept: Dict[str, Any], concept_index: int) -> Tuple[List[GeneratedQuestion], Optional[str]]:
-                """Process a single concept with semaphore-controlled concurrency."""
-                async with semaphore:
-                    logger.info(f"Processing concept {concept_index}/{len(concepts)}: {concept['name']}")
-                    try:
-                        # Determine number of questions dynamically
-                        num_questions = self.question_generator.calculate_questions_per_concept(
-                            concept_explanation=concept.get("explanation", ""),
-                            source_text=concept.get("source_text", ""),
-                            min_questions=min_questions_per_concept,
-                            max_questions=max_questions_per_concept
-                        )
-
+                yield {"type": "failed", "quiz_id": None}
+                return
+
+            # 3. Generate questions for each concept (in parallel batches)
+            # Concepts with identical content (repeated definitions,
+            # over-extraction) share one generation: group by content and
+            # fan the questions back out to each sibling's concept_id
+            groups: Dict[Tuple[str, str, str], List[Dict[str, Any]]] = {}
+            for concept in concepts:
+                key = (concept["name"], concept.get("explanation", ""), concept.get("source_text", ""))
+                groups.setdefault(key, []).append(concept)
+
+            concept_groups = list(groups.values())
+            if len(concept_groups) < len(concepts):
+                logger.info(f"Coalesced {len(concepts)} concepts into {len(concept_groups)} unique generations")
+
+            logger.info(f"Starting parallel question generation for {len(concept_groups)} concepts (max {MAX_CONCURRENT_GENERATIONS} concurrent)")
+
+            # Finished concepts flow through a bounded queue to a saver
+            # task, so DB writes overlap with in-flight generation
+            # instead of waiting for every concept to complete
+            queue: asyncio.Queue = asyncio.Queue(maxsize=MAX_CONCURRENT_GENERATIONS * 2)
+            saver = asyncio.create_task(self._save_loop(queue, quiz_id))
+
+            async def process_concept(group: List[Dict[str, Any]], concept_index: int) -> Dict[str, Any]:
+                """
+                Process one content-unique concept group. Generates once
+                for the first concept and clones the questions for any
+                identical siblings; everything goes straight onto the
+                save queue. Returns a result dict with the group's failed
+                concept names (empty on success) and question count.
+                Concurrency is bounded by the worker pool below.
+                """
+                concept = group[0]
+                logger.info(f"Processing concept {concept_index}/{len(concept_groups)}: {concept['name']}")
+                try:
+                    # Determine number of questions dynamically
+                    num_questions = self.question_generator.calculate_questions_per_concept(
+                        concept_explanation=concept.get("explanation", ""),
+                        source_text=concept.get("source_text", ""),
+                        min_questions=min_questions_per_concept,
+                        max_questions=max_questions_per_concept
+                    )
+
+                    # Identical concept content (re-uploads, shared
+                    # material) reuses previously generated questions
+                    cache_key = self._question_cache_key(concept, num_questions)
+                    questions = await self._get_cached_questions(cache_key, concept["id"])
+
+                    if questions is None:
                         # Generate questions
                         questions = await self.question_generator.generate_questions_for_concept(
                             concept_id=concept["id"],
@@ -110,48 +224,105 @@ class QuizGenerationService:
                             source_text=concept.get("source_text", ""),
                             num_questions=num_questions
                         )
-
                         if questions:
-                            return (questions, None)
-                        else:
-                            return ([], concept["name"])
-
-                    except Exception as e:
-                        logger.error(f"Failed to generate questions for concept {concept['name']}: {e}")
-                        return ([], concept["name"])
-
-            # Run all concepts in parallel with controlled concurrency
-            tasks = [
-                process_concept(concept, i + 1)
-                for i, concept in enumerate(concepts)
-            ]
-            results = await asyncio.gather(*tasks)
-
-            # Process results and save questions (ASYNC)
-            current_order_index = 0
-            for (questions, failed_concept_name) in results:
-                if failed_concept_name:
-                    failed_concepts.append(failed_concept_name)
-                    logger.warning(f"No questions generated for concept: {failed_concept_name}")
-                elif questions:
-                    saved_count = await self._save_questions(quiz_id, questions, current_order_index)
-                    current_order_index += saved_count
-                    total_questions += saved_count
-                    logger.info(f"Saved {saved_count} questions")
-
-            # 6. Update quiz status (ASYNC)
+                            await self._store_cached_questions(cache_key, questions)
+                    else:
+                        logger.info(f"Questions for concept '{concept['name']}' served from cache")
+
+                    if questions:
+                        await queue.put(questions)
+                        for sibling in group[1:]:
+                            await queue.put([
+                                q.model_copy(update={"concept_id": sibling["id"]})
+                                for q in questions
+                            ])
+                        return {
+                            "concept_id": concept["id"],
+                            "concept_name": concept["name"],
+                            "questions": len(questions) * len(group),
+                            "failed": []
+                        }
+                    return {
+                        "concept_id": concept["id"],
+                        "concept_name": concept["name"],
+                        "questions": 0,
+                        "failed": [c["name"] for c in group]
+                    }
+
+                except Exception as e:
+                    logger.error(f"Failed to generate questions for concept {concept['name']}: {e}")
+                    return {
+                        "concept_id": concept["id"],
+                        "concept_name": concept["name"],
+                        "questions": 0,
+                        "failed": [c["name"] for c in group]
+                    }
+
+            # A fixed pool of workers drains the concept groups, so only
+            # MAX_CONCURRENT_GENERATIONS coroutine frames exist at once
+            # instead of one pre-created task per concept; workers pick
+            # up the next group the moment one finishes
+            work_queue: asyncio.Queue = asyncio.Queue()
+            for i, group in enumerate(concept_groups):
+                work_queue.put_nowait((group, i + 1))
+
+            results_queue: asyncio.Queue = asyncio.Queue()
+
+            async def worker():
+                while True:
+                    try:
+                        group, index = work_queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    await results_queue.put(await process_concept(group, index))
+
+            failed_concepts: List[str] = []
+            try:
+                # TaskGroup gives structured cancellation: a worker
+                # failure (or the generator being closed mid-stream)
+                # tears the whole pool down instead of leaking tasks
+                async with asyncio.TaskGroup() as tg:
+                    for _ in range(min(MAX_CONCURRENT_GENERATIONS, len(concept_groups))):
+                        tg.create_task(worker())
+
+                    for completed in range(1, len(concept_groups) + 1):
+                        result = await results_queue.get()
+                        failed_concepts.extend(result["failed"])
+                        yield {
+                            "type": "concept",
+                            "concept_id": result["concept_id"],
+                            "concept_name": result["concept_name"],
+                            "questions": result["questions"],
+                            "progress": completed / len(concept_groups)
+                        }
+            except BaseException:
+                saver.cancel()
+                raise
+
+            # Signal end-of-stream and wait for the saver to drain
+            await queue.put(None)
+            total_questions = await saver
+
+            for failed_concept_name in failed_concepts:
+                logger.warning(f"No questions generated for concept: {failed_concept_name}")
+
+            # 4. Update quiz status (ASYNC)
             if total_questions > 0:
                 await self._update_quiz_status(quiz_id, "completed")
                 logger.info(
                     f"Quiz generation completed: {total_questions} questions generated "
                     f"({len(failed_concepts)} concepts failed)"
                 )
+                yield {
+                    "type": "completed",
+                    "quiz_id": quiz_id,
+                    "total_questions": total_questions,
+                    "failed_concepts": failed_concepts
+                }
             else:
                 await self._update_quiz_status(quiz_id, "failed")
                 logger.error("Quiz generation failed: no questions generated")
-                return None
-
-            return quiz_id
+                yield {"type": "failed", "quiz_id": quiz_id}
 
         except Exception as e:
             logger.error(f"Quiz generation failed for document {document_id}: {e}")
@@ -160,41 +331,122 @@ class QuizGenerationService:
                     await self._update_quiz_status(quiz_id, "failed")
             except:
                 pass
-            return None
+            yield {"type": "failed", "quiz_id": quiz_id}
+
+    async def _save_loop(self, queue: "asyncio.Queue", quiz_id: str) -> int:
+        """
+        Consume finished question batches off the queue and persist them
+        as they arrive, so save latency overlaps generation (ASYNC).
+        A None sentinel ends the loop. Returns total questions saved.
+
+        Must never die before the sentinel: producers block on the
+        bounded queue, so a crashed saver would wedge the whole
+        pipeline with the quiz stuck in "generating". A failed batch is
+        logged and counted as zero saved, and the loop keeps draining.
+        """
+        total_saved = 0
+        while True:
+            questions = await queue.get()
+            if questions is None:
+                return total_saved
+            try:
+                saved_count = await self._save_questions(quiz_id, questions, total_saved)
+            except Exception as e:
+                logger.error(f"Failed to save question batch for quiz {quiz_id}: {e}")
+                continue
+            total_saved += saved_count
+            logger.info(f"Saved {saved_count} questions")
+
+    def _question_cache_key(self, concept: Dict[str, Any], num_questions: int) -> str:
+        """Content-addressed cache key for a concept's generated questions."""
+        payload = "|".join([
+            self.question_generator.model,
+            _QUESTION_PROMPT_VERSION,
+            concept["name"],
+            concept.get("explanation", ""),
+            concept.get("source_text", ""),
+            str(num_questions),
+        ])
+        return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+    async def _get_cached_questions(self, cache_key: str, concept_id: str) -> Optional[List[GeneratedQuestion]]:
+        """Look up questions generated for identical concept content (ASYNC)."""
+        try:
+            res = await run_db_operation(
+                lambda: self.supabase.table("question_cache")
+                    .select("questions_json")
+                    .eq("key", cache_key)
+                    .limit(1)
+                    .execute()
+            )
+            if res.data:
+                # Rebind to this concept: identical content can appear
+                # under a different concept row in another document
+                return [
+                    GeneratedQuestion(**{**item, "concept_id": concept_id})
+                    for item in res.data[0]["questions_json"]
+                ]
+        except Exception as e:
+            # Cache problems must never break generation
+            logger.warning(f"Question cache lookup failed: {e}")
+        return None
+
+    async def _store_cached_questions(self, cache_key: str, questions: List[GeneratedQuestion]):
+        """Store generated questions for reuse by identical concepts (ASYNC)."""
+        try:
+            payload = [q.model_dump(mode="json") for q in questions]
+            await run_db_operation(
+                lambda: self.supabase.table("question_cache").upsert({
+                    "key": cache_key,
+                    "questions_json": payload
+                }).execute()
+            )
+        except Exception as e:
+            logger.warning(f"Failed to store question cache entry: {e}")
 
     async def _get_document(self, document_id: str) -> Optional[Dict[str, Any]]:
-        """Fetch document from database (ASYNC)."""
+        """
+        Fetch document from database (ASYNC). Projects only the columns
+        quiz generation reads - select("*") would drag the full
+        extracted_text blob over the wire just to check a status flag.
+        Hits within _DOC_CACHE_TTL_SECONDS are served from memory;
+        misses and errors are never cached.
+        """
+        cached = _doc_cache.get(document_id)
+        if cached is not None and cached[1] > asyncio.get_running_loop().time():
+            return cached[0]
+
         try:
             response = await run_db_operation(
-                lambda: self.supabase.table("documents").select("*").eq("id", document_id).single().execute()
+                lambda: self.supabase.table("documents").select("id,status,title").eq("id", document_id).single().execute()
             )
-            return response.data if response.data else None
+            doc = response.data if response.data else None
         except Exception as e:
             logger.error(f"Error fetching document {document_id}: {e}")
             return None
 
+        if doc is not None:
+            if len(_doc_cache) >= _DOC_CACHE_MAX_ENTRIES:
+                _doc_cache.clear()
+            _doc_cache[document_id] = (doc, asyncio.get_running_loop().time() + _DOC_CACHE_TTL_SECONDS)
+        return doc
+
     async def _get_document_concepts(self, document_id: str) -> List[Dict[str, Any]]:
         """
         Fetch all concepts for a document (via topics) (ASYNC).
+        One embedded-join query - the topics!inner embed pushes the
+        document filter into a single SQL JOIN instead of fetching topic
+        ids first and issuing a second IN query.
         Returns list of concept dictionaries.
         """
         try:
-            # Get all topics for this document
-            topics_response = await run_db_operation(
-                lambda: self.supabase.table("topics").select("id").eq("document_id", document_id).execute()
-            )
-
-            if not topics_response.data:
-                return []
-
-            topic_ids = [topic["id"] for topic in topics_response.data]
-
-            # Get all concepts for these topics
-            concepts_response = await run_db_operation(
-                lambda: self.supabase.table("concepts").select("*").in_("topic_id", topic_ids).execute()
+            response = await run_db_operation(
+                lambda: self.supabase.table("concepts")
+                    .select("id,name,explanation,source_text,topics!inner(document_id)")
+                    .eq("topics.document_id", document_id)
+                    .execute()
             )
-
-            return concepts_response.data if concepts_response.data else []
+            return response.data if response.data else []
 
         except Exception as e:
             logger.error(f"Error fetching concepts for document {document_id}: {e}")
@@ -207,7 +459,12 @@ class QuizGenerationService:
         document_title: str,
         concept_count: int
     ) -> Optional[str]:
-        """Create a new quiz record in the database (ASYNC)."""
+        """
+        Create a new quiz record in the database (ASYNC). Inserted
+        directly in 'generating' status - nothing observes a separate
+        'pending' state between creation and generation, so the old
+        follow-up status update was a wasted round-trip.
+        """
         try:
             quiz_title = f"Quiz: {document_title}"
             quiz_description = (
@@ -221,7 +478,7 @@ class QuizGenerationService:
                     "description": quiz_description,
                     "document_id": document_id,
                     "user_id": user_id,
-                    "generation_status": "pending"
+                    "generation_status": "generating"
                 }).execute()
             )
 
@@ -235,12 +492,15 @@ class QuizGenerationService:
             return None
 
     async def _update_quiz_status(self, quiz_id: str, status: str) -> bool:
-        """Update quiz generation status (ASYNC)."""
+        """
+        Update quiz generation status (ASYNC). return=minimal skips
+        serializing and parsing the updated row - only success matters.
+        """
         try:
             await run_db_operation(
                 lambda: self.supabase.table("quizzes").update({
                     "generation_status": status
-                }).eq("id", quiz_id).execute()
+                }, returning=ReturnMethod.minimal).eq("id", quiz_id).execute()
             )
             return True
         except Exception as e:
@@ -256,45 +516,202 @@ class QuizGenerationService:
         """
         Save generated questions and their options to database (ASYNC).
         Shuffles option order to randomize correct answer position.
+
+        Prefers the save_questions_bulk RPC (db/functions.sql), which
+        inserts questions and options in one statement and one
+        transaction. If the RPC is unavailable it falls back to two bulk
+        inserts - all questions, then all options zipped onto the
+        returned ids - and from there to per-row inserts.
         Returns count of successfully saved questions.
         """
-        saved_count = 0
-
-        for i, question in enumerate(questions):
-            try:
-                # Create a list of options with their original data
-                options_list = list(question.options)
-
-                # Shuffle the options to randomize correct answer position
-                random.shuffle(options_list)
+        if not questions:
+            return 0
+
+        # Shuffle each question's options up front so every save path
+        # persists identical ordering. The correct index comes from an
+        # identity lookup of the correct option after the shuffle - one
+        # pass, no re-scan of is_correct per payload build. A question
+        # with no correct option (possible via stale question_cache
+        # rows) is dropped rather than failing the whole batch.
+        valid_questions: List[GeneratedQuestion] = []
+        shuffled_options: List[List[QuestionOption]] = []
+        correct_indices: List[int] = []
+        shuffle = random.shuffle  # local bind: skip the module lookup per question
+        for question in questions:
+            options_list = list(question.options)
+            correct_opt = next((opt for opt in options_list if opt.is_correct), None)
+            if correct_opt is None:
+                logger.error(f"Skipping question with no correct option: {question.question[:50]}")
+                continue
+            shuffle(options_list)
+            valid_questions.append(question)
+            shuffled_options.append(options_list)
+            correct_indices.append(options_list.index(correct_opt))
+
+        questions = valid_questions
+        if not questions:
+            return 0
+
+        rpc_rows = [
+            {
+                "question": question.question,
+                "correct_answer": correct_indices[i],
+                "order_index": start_order_index + i,
+                "concept_id": question.concept_id,
+                "hint": question.hint,
+                "difficulty_level": question.difficulty_level,
+                "options": [
+                    {
+                        "option_text": opt.option_text,
+                        "option_index": new_idx,
+                        "is_correct": opt.is_correct,
+                        "explanation": opt.explanation
+                    }
+                    for new_idx, opt in enumerate(options_list)
+                ]
+            }
+            for i, (question, options_list) in enumerate(zip(questions, shuffled_options))
+        ]
+
+        # Pre-built requests hand their bound .execute straight to
+        # run_db_operation - no per-call closure allocations on the
+        # hottest write path
+        rpc_request = self.supabase.rpc("save_questions_bulk", {
+            "p_quiz_id": quiz_id,
+            "p_rows": rpc_rows
+        })
+        try:
+            await run_db_operation(rpc_request.execute)
+            return len(questions)
+        except Exception as e:
+            logger.warning(f"save_questions_bulk RPC failed ({e}), falling back to bulk inserts")
+
+        question_rows = [
+            {
+                "quiz_id": quiz_id,
+                "question": question.question,
+                "options": [],  # Legacy field, keep empty
+                "correct_answer": correct_indices[i],
+                "explanation": "",  # Legacy field, keep empty
+                "order_index": start_order_index + i,
+                "concept_id": question.concept_id,
+                "hint": question.hint,
+                "difficulty_level": question.difficulty_level
+            }
+            for i, question in enumerate(questions)
+        ]
+
+        insert_request = self.supabase.table("questions").insert(question_rows)
+        try:
+            response = await run_db_operation(insert_request.execute)
+            inserted = response.data or []
+            if len(inserted) != len(questions):
+                raise ValueError(f"Expected {len(questions)} inserted rows, got {len(inserted)}")
+        except Exception as e:
+            logger.warning(f"Bulk question insert failed ({e}), falling back to per-question inserts")
+            return await self._save_questions_per_row(
+                quiz_id, questions, shuffled_options, correct_indices, start_order_index
+            )
 
-                # Find the new index of the correct answer after shuffling
-                correct_answer_index = next(
-                    new_idx for new_idx, opt in enumerate(options_list) if opt.is_correct
+        option_rows = [
+            {
+                "question_id": row["id"],
+                "option_text": opt.option_text,
+                "option_index": new_idx,  # Use new shuffled index
+                "is_correct": opt.is_correct,
+                "explanation": opt.explanation
+            }
+            for row, options_list in zip(inserted, shuffled_options)
+            for new_idx, opt in enumerate(options_list)
+        ]
+
+        options_request = self.supabase.table("question_options").insert(
+            option_rows, returning=ReturnMethod.minimal
+        )
+        try:
+            # Option rows are write-only here; skip the echoed bodies
+            await run_db_operation(options_request.execute)
+        except Exception as e:
+            # Questions are already in; retry their options row-by-row
+            # rather than re-inserting the questions
+            logger.warning(f"Bulk option insert failed ({e}), retrying per question")
+            saved_count = 0
+            for row, options_list in zip(inserted, shuffled_options):
+                rows = [
+                    {
+                        "question_id": row["id"],
+                        "option_text": opt.option_text,
+                        "option_index": new_idx,
+                        "is_correct": opt.is_correct,
+                        "explanation": opt.explanation
+                    }
+                    for new_idx, opt in enumerate(options_list)
+                ]
+                retry_request = self.supabase.table("question_options").insert(
+                    rows, returning=ReturnMethod.minimal
                 )
+                try:
+                    await run_db_operation(retry_request.execute)
+                    saved_count += 1
+                except Exception as e2:
+                    logger.error(f"Error saving options for question {row['id']}: {e2}")
+            return saved_count
 
-                # Insert question record with the new correct answer index (ASYNC)
-                question_response = await run_db_operation(
-                    lambda q=question, idx=i, ca_idx=correct_answer_index: self.supabase.table("questions").insert({
-                        "quiz_id": quiz_id,
-                        "question": q.question,
-                        "options": [],  # Legacy field, keep empty
-                        "correct_answer": ca_idx,
-                        "explanation": "",  # Legacy field, keep empty
-                        "order_index": start_order_index + idx,
-                        "concept_id": q.concept_id,
-                        "hint": q.hint,
-                        "difficulty_level": q.difficulty_level
-                    }).execute()
-                )
+        return len(questions)
+
+    async def _save_questions_per_row(
+        self,
+        quiz_id: str,
+        questions: List[GeneratedQuestion],
+        shuffled_options: List[List[QuestionOption]],
+        correct_indices: List[int],
+        start_order_index: int
+    ) -> int:
+        """
+        Per-question fallback for _save_questions: two inserts per
+        question, skipping rows that fail so one bad question doesn't
+        lose the rest. The questions save concurrently (bounded by
+        _SAVE_CONCURRENCY) so their round-trips overlap instead of
+        serializing (ASYNC).
+        """
+        results = await asyncio.gather(
+            *(self._save_one_question(quiz_id, question, options_list, correct_index, start_order_index + i)
+              for i, (question, options_list, correct_index)
+              in enumerate(zip(questions, shuffled_options, correct_indices))),
+            return_exceptions=True
+        )
+        return sum(r for r in results if isinstance(r, int))
+
+    async def _save_one_question(
+        self,
+        quiz_id: str,
+        question: GeneratedQuestion,
+        options_list: List[QuestionOption],
+        correct_answer_index: int,
+        order_index: int
+    ) -> int:
+        """Insert one question and its options; 1 on success, 0 on failure (ASYNC)."""
+        async with _SAVE_CONCURRENCY:
+            try:
+                question_request = self.supabase.table("questions").insert({
+                    "quiz_id": quiz_id,
+                    "question": question.question,
+                    "options": [],  # Legacy field, keep empty
+                    "correct_answer": correct_answer_index,
+                    "explanation": "",  # Legacy field, keep empty
+                    "order_index": order_index,
+                    "concept_id": question.concept_id,
+                    "hint": question.hint,
+                    "difficulty_level": question.difficulty_level
+                })
+                question_response = await run_db_operation(question_request.execute)
 
                 if not question_response.data or len(question_response.data) == 0:
                     logger.error(f"Failed to insert question: {question.question[:50]}")
-                    continue
+                    return 0
 
                 question_id = question_response.data[0]["id"]
 
-                # Insert question options with new shuffled indices (ASYNC)
                 options_data = [
                     {
                         "question_id": question_id,
@@ -306,13 +723,12 @@ class QuizGenerationService:
                     for new_idx, opt in enumerate(options_list)
                 ]
 
-                await run_db_operation(
-                    lambda od=options_data: self.supabase.table("question_options").insert(od).execute()
+                options_request = self.supabase.table("question_options").insert(
+                    options_data, returning=ReturnMethod.minimal
                 )
-                saved_count += 1
+                await run_db_operation(options_request.execute)
+                return 1
 
             except Exception as e:
                 logger.error(f"Error saving question: {e}")
-                continue
-
-        return saved_count
+                return 0
@@ -0,0 +1,36 @@
+-- Cache tables used by the backend to skip repeated expensive work.
+-- Apply via the Supabase SQL editor or a migration.
+-- RLS is enabled with no policies: only the backend's service-role key
+-- (which bypasses RLS) may touch these tables. Without it PostgREST
+-- would let any anon/authenticated client read cached extracted text
+-- or poison cache rows the backend trusts.
+
+-- Parsed topic/concept structures keyed by (model | prompt version | chunk)
+-- content hash, so re-analyzing identical chunks skips the Claude call.
+CREATE TABLE IF NOT EXISTS llm_response_cache (
+    key text PRIMARY KEY,
+    topics_json jsonb NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+
+ALTER TABLE llm_response_cache ENABLE ROW LEVEL SECURITY;
+
+-- Extracted text keyed by (file type | file content) hash, so re-uploads
+-- of identical files skip PDF/DOCX/PPTX parsing.
+CREATE TABLE IF NOT EXISTS extracted_text_cache (
+    key text PRIMARY KEY,
+    extracted_text text NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+
+ALTER TABLE extracted_text_cache ENABLE ROW LEVEL SECURITY;
+
+-- Generated questions keyed by (model | prompt version | concept content)
+-- hash, so identical concepts skip Sonnet question generation.
+CREATE TABLE IF NOT EXISTS question_cache (
+    key text PRIMARY KEY,
+    questions_json jsonb NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+
+ALTER TABLE question_cache ENABLE ROW LEVEL SECURITY;
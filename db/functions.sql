@@ -0,0 +1,78 @@
+-- SQL functions called by the backend via PostgREST RPC.
+-- Apply via the Supabase SQL editor or a migration.
+
+-- Persist a batch of quiz questions and their options in one statement.
+-- The CTE insert returns the generated question ids, which the options
+-- insert joins back on order_index - one round-trip and one transaction
+-- in place of two sequential bulk inserts. Rows arrive as a jsonb array
+-- of {question, correct_answer, order_index, concept_id, hint,
+-- difficulty_level, options:[{option_text, option_index, is_correct,
+-- explanation}]} objects. Returns the number of questions inserted.
+CREATE OR REPLACE FUNCTION save_questions_bulk(p_quiz_id uuid, p_rows jsonb)
+RETURNS integer
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    WITH rows AS (
+        SELECT r.question, r.correct_answer, r.order_index, r.concept_id,
+               r.hint, r.difficulty_level, r.options
+        FROM jsonb_to_recordset(p_rows) AS r(
+            question text,
+            correct_answer integer,
+            order_index integer,
+            concept_id uuid,
+            hint text,
+            difficulty_level text,
+            options jsonb
+        )
+    ),
+    inserted_questions AS (
+        INSERT INTO questions
+            (quiz_id, question, options, correct_answer, explanation,
+             order_index, concept_id, hint, difficulty_level)
+        SELECT p_quiz_id, question, '[]'::jsonb, correct_answer, '',
+               order_index, concept_id, hint, difficulty_level
+        FROM rows
+        RETURNING id, order_index
+    )
+    INSERT INTO question_options
+        (question_id, option_text, option_index, is_correct, explanation)
+    SELECT iq.id, o.option_text, o.option_index, o.is_correct, o.explanation
+    FROM inserted_questions iq
+    JOIN rows r ON r.order_index = iq.order_index
+    CROSS JOIN LATERAL jsonb_to_recordset(r.options) AS o(
+        option_text text,
+        option_index integer,
+        is_correct boolean,
+        explanation text
+    );
+
+    RETURN jsonb_array_length(p_rows);
+END;
+$$;
+
+-- Admin/repair helper: count a document's concepts and mark it
+-- completed when analysis produced any. The processing pipeline no
+-- longer calls this - analyze_document reports the count it wrote -
+-- but it remains useful for fixing up documents by hand.
+CREATE OR REPLACE FUNCTION finalize_document(doc_id uuid)
+RETURNS integer
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    concept_count integer;
+BEGIN
+    SELECT count(*) INTO concept_count
+    FROM concepts c
+    JOIN topics t ON t.id = c.topic_id
+    WHERE t.document_id = doc_id;
+
+    IF concept_count > 0 THEN
+        UPDATE documents
+        SET status = 'completed', error_message = NULL
+        WHERE id = doc_id;
+    END IF;
+
+    RETURN concept_count;
+END;
+$$;
@@ -0,0 +1,29 @@
+-- Indexes backing the hot filter + order queries issued by this backend
+-- and by the frontend's direct Supabase reads.
+--
+-- Apply via the Supabase SQL editor or a migration. All statements are
+-- idempotent.
+
+-- Quiz generation: delete/regenerate lookups and frontend quiz lists
+CREATE INDEX IF NOT EXISTS idx_quizzes_document_id
+    ON quizzes (document_id);
+CREATE INDEX IF NOT EXISTS idx_quiz_summary_user_created
+    ON quizzes (user_id, created_at DESC);
+
+-- get_quiz-style reads: questions in order, options in order
+CREATE INDEX IF NOT EXISTS idx_questions_quiz_order
+    ON questions (quiz_id, order_index);
+CREATE INDEX IF NOT EXISTS idx_options_question_order
+    ON question_options (question_id, option_index);
+
+-- Analysis pipeline: topics per document, concepts per topic.
+-- The unique index also makes concurrent chunk analysis race-safe:
+-- topic writes upsert on (document_id, name).
+CREATE UNIQUE INDEX IF NOT EXISTS idx_topics_document_name
+    ON topics (document_id, name);
+CREATE INDEX IF NOT EXISTS idx_concepts_topic_id
+    ON concepts (topic_id);
+
+-- Attempt history (read by the frontend)
+CREATE INDEX IF NOT EXISTS idx_uqa_user_quiz_completed
+    ON user_quiz_attempts (user_id, quiz_id, completed_at DESC);